@@ -31,12 +31,14 @@ def update(ndays=30):
     """Run the daily update."""
 
     # Load the old processed data
-    old_data = gpd.read_file(DATA_DIR / "processed" / "asbestos-data.geojson")
+    old_data = gpd.read_parquet(DATA_DIR / "processed" / "asbestos-data.parquet")
+    assert old_data["permit_number"].duplicated().sum() == 0
 
     # Initialize the database scraper
     logger.info(f"Downloading raw data from past {ndays} days")
-    scraper = DatabaseScraper(ndays=ndays, debug=False)
-    new_data = scraper.run()
+    with DatabaseScraper(ndays=ndays, debug=False) as scraper:
+        new_data = scraper.run()
+    new_data = new_data.drop_duplicates(subset=["permit_number"], keep="last")
 
     # Update any old data
     old_sel = new_data["permit_number"].isin(old_data["permit_number"])
@@ -44,12 +46,9 @@ def update(ndays=30):
 
     # Update info for overlap
     overlap_columns = new_data.columns.intersection(old_data.columns)
-    for permit_number in new_data.loc[old_sel, "permit_number"]:
-        old_data.loc[
-            old_data["permit_number"] == permit_number, overlap_columns
-        ] = new_data.loc[
-            new_data["permit_number"] == permit_number, overlap_columns
-        ].values
+    old_data = old_data.set_index("permit_number")
+    old_data.update(new_data.loc[old_sel, overlap_columns].set_index("permit_number"))
+    old_data = old_data.reset_index()
 
     # Get the new permits
     if new_sel.sum():
@@ -81,26 +80,38 @@ def update(ndays=30):
     _run_etl(out)
 
 
+def _to_parquet(df, path):
+    """Save to GeoParquet, storing object columns as strings like GeoJSON did."""
+
+    # Mixed-type columns (e.g., 5 and "see attached") can't be written to Arrow
+    df = df.copy()
+    for col in df.columns.drop("geometry"):
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+
+    df.to_parquet(path, index=False)
+
+
 def _run_etl(df):
     # Save asbestos to AWS
     asbestos = pd.DataFrame(df.drop(labels=["geometry"] + SCHOOL_COLUMNS[3:], axis=1))
     upload_to_s3(asbestos.to_json(orient="records"), "asbestos-data.json")
 
     # And save locally
-    df.to_file(DATA_DIR / "processed" / "asbestos-data.geojson", driver="GeoJSON")
+    _to_parquet(df, DATA_DIR / "processed" / "asbestos-data.parquet")
 
     # Create the schools database
     schools = df[SCHOOL_COLUMNS + ["geometry"]].drop_duplicates()
 
     # Remove duplicates that have only different geometries
-    duplicated_schools = schools.drop(columns=["geometry"]).duplicated()
+    duplicated_schools = schools.duplicated(subset=SCHOOL_COLUMNS)
     schools = schools.loc[~duplicated_schools]
 
     # Save to AWS
     upload_to_s3(schools.to_json(), "schools.json")
 
     # And save locally
-    schools.to_file(DATA_DIR / "processed" / "schools.geojson", driver="GeoJSON")
+    _to_parquet(schools, DATA_DIR / "processed" / "schools.parquet")
 
 
 @main.command()
@@ -1,25 +1,46 @@
 import os
-from io import StringIO
+from functools import lru_cache
+from io import BytesIO
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from dotenv import find_dotenv, load_dotenv
 
 from .data import load_schools_database
 
 
-def upload_to_s3(data, filename):
-    """Upload data to a public AWS s3 bucket."""
+@lru_cache(maxsize=1)
+def get_s3_resource():
+    """Get the s3 resource, shared across uploads."""
 
     # Load the credentials
     load_dotenv(find_dotenv())
 
     # Initialize the s3 resource
-    s3_resource = boto3.resource("s3")
+    config = Config(
+        max_pool_connections=16, retries={"max_attempts": 3, "mode": "adaptive"}
+    )
+    return boto3.resource("s3", config=config)
+
+
+def upload_to_s3(data, filename):
+    """
+    Upload data to a public AWS s3 bucket.
+
+    Large payloads are uploaded in parallel chunks via a multipart upload.
+    """
 
-    # Write to a buffer
-    buffer = StringIO()
-    buffer.write(data)
+    # Encode to bytes
+    if isinstance(data, str):
+        data = data.encode("utf-8")
 
     # Upload to s3
     BUCKET = "asbestos-dashboard"
-    s3_resource.Object(BUCKET, filename).put(Body=buffer.getvalue(), ACL="public-read")
+    get_s3_resource().meta.client.upload_fileobj(
+        BytesIO(data),
+        BUCKET,
+        filename,
+        ExtraArgs={"ACL": "public-read", "ContentType": "application/json"},
+        Config=TransferConfig(use_threads=True, max_concurrency=8),
+    )
@@ -13,28 +13,63 @@ from .. import DATA_DIR
 from .schools import load_schools_database
 
 
+def read_excel_cached(filename):
+    """
+    Read the first sheet of an Excel file.
+
+    The parsed data is pickled next to the file, along with the file's
+    modification time and size, and re-used as long as both are unchanged.
+    """
+    filename = Path(filename)
+    cache = filename.with_suffix(".pkl")
+    stat = filename.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    if cache.exists():
+        # An unreadable cache (e.g., truncated) is treated as a miss
+        try:
+            cached = pd.read_pickle(cache)
+        except Exception:
+            logger.warning(f"Ignoring unreadable cache file '{cache}'")
+            cached = None
+        if isinstance(cached, dict) and cached.get("stamp") == stamp:
+            return cached["data"]
+
+    data = pd.read_excel(filename, sheet_name=0)
+
+    # Write to a temporary file first, so an interrupted write can't leave a
+    # partial cache behind
+    tmp_cache = cache.with_suffix(".tmp.pkl")
+    pd.to_pickle({"stamp": stamp, "data": data}, tmp_cache)
+    os.replace(tmp_cache, cache)
+
+    return data
+
+
+def get_latest_raw_file():
+    """Get the most recently modified raw Citizenserve report."""
+    return max(Path(DATA_DIR / "raw").glob("Citizen*.xlsx"), key=os.path.getmtime)
+
+
 def trim_to_school_district(data):
     """
     Trim the input data to rows associated with the School District.
     This will check the owner name and owner address.
     """
 
-    def test_owner(x):
-        if isinstance(x, str):
-            x = x.lower()
-            return ("school" in x and "phila" in x and "dis" in x) or x == "sdp"
-        else:
-            return False
-
-    def test_address(x):
-        if isinstance(x, str):
-            x = x.lower()
-            return "440" in x and "broad" in x
-        else:
-            return False
+    # Test the owner name
+    owner = data["facility_owner"].str.lower()
+    sel1 = (
+        owner.str.contains("school", na=False, regex=False)
+        & owner.str.contains("phila", na=False, regex=False)
+        & owner.str.contains("dis", na=False, regex=False)
+    ) | (owner == "sdp")
+
+    # Test the owner address
+    address = data["facility_owner_address"].str.lower()
+    sel2 = address.str.contains("440", na=False, regex=False) & address.str.contains(
+        "broad", na=False, regex=False
+    )
 
-    sel1 = data["facility_owner"].apply(test_owner)
-    sel2 = data["facility_owner_address"].apply(test_address)
     return data.loc[sel1 | sel2]
 
 
@@ -49,26 +84,10 @@ def extract_asbestos_data(filename=None):
     """
     # Use the last modified file
     if filename is None:
-        raw_data_files = sorted(
-            Path(DATA_DIR / "raw").glob("Citizen*.xlsx"),
-            key=lambda f: os.path.getmtime(f),
-        )
-        filename = raw_data_files[-1]
+        filename = get_latest_raw_file()
 
     # Load the raw data
-    data = pd.read_excel(filename, sheet_name=0)
-
-    # Parse dates
-    date_columns = [
-        "Application Date",
-        "Approval Date",
-        "Issue Date",
-        "Expiration Date",
-        "Work Start",
-        "Complete Date",
-    ]
-    for col in date_columns:
-        data[col] = pd.to_datetime(data[col]).dt.strftime("%m-%d-%Y")
+    data = read_excel_cached(filename)
 
     # Rename the columns
     COLUMNS = {
@@ -110,9 +129,37 @@ def extract_asbestos_data(filename=None):
     # Trim to school district
     school_district = trim_to_school_district(data)
 
+    # Parse dates
+    date_columns = [
+        "application_date",
+        "approval_date",
+        "issue_date",
+        "expiration_date",
+        "work_start",
+        "complete_date",
+    ]
+    dates = school_district[date_columns].apply(pd.to_datetime)
+
     # Trim to 2016 onwards
-    sel = pd.to_datetime(school_district["application_date"]) >= "01-01-2016"
-    school_district = school_district.loc[sel]
+    sel = dates["application_date"] >= "2016-01-01"
+    school_district = school_district.loc[sel].assign(
+        **{col: dates.loc[sel, col].dt.strftime("%m-%d-%Y") for col in date_columns}
+    )
+
+    # Store the low-cardinality string columns as categoricals
+    school_district = school_district.astype(
+        {
+            col: "category"
+            for col in [
+                "subtype",
+                "status",
+                "project_type",
+                "operation_type",
+                "facility_name",
+                "facility_owner",
+            ]
+        }
+    )
 
     # Log
     logger.info(f"Size of original database: {len(data)}")
@@ -138,12 +185,12 @@ def geocode(df, address_column="facility_address", ignore_failure=False):
     path = DATA_DIR / "interim" / "geocoded_addresses.xlsx"
     geocoded_addresses = None
     if path.exists():
-        geocoded_addresses = pd.read_excel(path)
+        geocoded_addresses = read_excel_cached(path)
 
     # Manual geocodes
     path = DATA_DIR / "interim" / "manual_geocoded_addresses.xlsx"
     if path.exists():
-        manual_addresses = pd.read_excel(path)
+        manual_addresses = read_excel_cached(path)
         if geocoded_addresses is not None:
             geocoded_addresses = pd.concat([geocoded_addresses, manual_addresses])
         else:
@@ -200,16 +247,14 @@ def geocode(df, address_column="facility_address", ignore_failure=False):
     missing = X.loc[missing_sel]
     logger.info(f"Found coordinates for {len(result)-len(missing)} addresses")
 
-    # Merge back into the original data frame
-    out = df.merge(X, on=address_column, how="left", suffixes=("", "_y"))
+    # Add the new geocoded columns to the original data frame
+    X = X.set_index(address_column)
+    out = df.join(X[X.columns.difference(df.columns)], on=address_column)
 
-    # Merge in the coordinates
-    if "lat_y" in out.columns:
-        out["lat"] = out["lat"].fillna(out["lat_y"])
-        out = out.drop(labels=["lat_y"], axis=1)
-    if "lng_y" in out.columns:
-        out["lng"] = out["lng"].fillna(out["lng_y"])
-        out = out.drop(labels=["lng_y"], axis=1)
+    # Fill in the missing coordinates
+    out = out.set_index(address_column)
+    out.update(X[X.columns.intersection(out.columns)], overwrite=False)
+    out = out.reset_index()
 
     # Split into mot missing and missing
     sel = out.lat.isnull() | out.lng.isnull()
@@ -220,7 +265,7 @@ def geocode(df, address_column="facility_address", ignore_failure=False):
     columns = [address_column, "lat", "lng"]
     path = DATA_DIR / "interim" / "geocoded_addresses.xlsx"
     if path.exists():
-        not_missing = pd.concat([not_missing[columns], pd.read_excel(path)])
+        not_missing = pd.concat([not_missing[columns], read_excel_cached(path)])
     not_missing = not_missing.drop_duplicates(subset=[address_column])
 
     # The missing geocodes
@@ -241,19 +286,15 @@ def transform(data):
     from ..scrape import update_permit_urls
 
     # Add project length
-    data["project_length"] = (
-        (
-            pd.to_datetime(data["complete_date"]) - pd.to_datetime(data["work_start"])
-        ).dt.total_seconds()
-        / 60
-        / 60
-        / 24
-    )
+    complete_date = pd.to_datetime(data["complete_date"], format="%m-%d-%Y")
+    work_start = pd.to_datetime(data["work_start"], format="%m-%d-%Y")
+    data["project_length"] = (complete_date - work_start) / np.timedelta64(1, "D")
 
     # Convert to a geodataframe
-    gdf = gpd.GeoDataFrame(
-        data, geometry=gpd.points_from_xy(data["lng"], data["lat"]), crs="EPSG:4326"
-    ).to_crs(epsg=2272)
+    geometry = gpd.points_from_xy(
+        data["lng"].to_numpy(), data["lat"].to_numpy(), crs="EPSG:4326"
+    )
+    gdf = gpd.GeoDataFrame(data, geometry=geometry)
 
     # Fill street_address with Site Address
     gdf["street_address"] = gdf["street_address"].fillna(gdf["facility_address"])
@@ -295,16 +336,15 @@ def transform(data):
             "school_website",
             "year_opened",
             "year_closed",
-            "lat",
-            "lng",
+            "geometry",
         ]
     ]
 
-    # Drop duplicate coords
-    geo_coords = data[["school_name", "lat", "lng"]].drop_duplicates(
+    # Use a single location per school
+    geo_coords = data[["school_name", "geometry"]].drop_duplicates(
         subset=["school_name"]
     )
-    data = data.drop(labels=["lat", "lng"], axis=1).merge(
+    data = data.drop(labels=["geometry"], axis=1).merge(
         geo_coords, on="school_name", how="left"
     )
 
@@ -312,13 +352,7 @@ def transform(data):
     closed = data["year_closed"].notnull()
     data.loc[closed, "school_name"] += " (Closed)"
 
-    # Merge in the existing permit urls
-    if "permit_url" not in data.columns:
-
-        urls = pd.read_csv(DATA_DIR / "interim" / "permit-number-urls.csv")
-        data = data.merge(urls, on="permit_number", how="left")
-
-    # Update any missing urls
+    # Fill in the permit urls (from the cache, or by scraping)
     data = update_permit_urls(data)
 
     # Fix school level
@@ -328,15 +362,17 @@ def transform(data):
 
     # Return
     return gpd.GeoDataFrame(
-        data, geometry=gpd.points_from_xy(data["lng"], data["lat"]), crs="EPSG:4326"
-    ).drop(labels=["lat", "lng"], axis=1)
+        data.drop(labels=["geometry"], axis=1),
+        geometry=data["geometry"].values,
+        crs="EPSG:4326",
+    )
 
 
 def load_asbestos_data(filename=None, ignore_failure=False, processed=False):
     """Load the data from the raw .xlsx file."""
 
     if processed:
-        return gpd.read_file(DATA_DIR / "processed" / "asbestos-data.geojson")
+        return gpd.read_parquet(DATA_DIR / "processed" / "asbestos-data.parquet")
 
     # Extract the data
     return (
@@ -349,18 +385,12 @@ def load_asbestos_data(filename=None, ignore_failure=False, processed=False):
 def _clean_columns(df, cols):
     """Clean the columns."""
 
-    # Copy the data
-    df = df.copy()
-
     # Copy the columns
-    for col in cols:
-        df[f"{col}_clean"] = df[col]
+    clean_cols = [f"{col}_clean" for col in cols]
+    df = df.assign(**{f"{col}_clean": df[col] for col in cols})
 
     # Clean the columns
-    df = skool.clean_strings(
-        df,
-        [f"{col}_clean" for col in cols],
-    )
+    df = skool.clean_strings(df, clean_cols)
 
     # Replace
     replace = {
@@ -370,8 +400,7 @@ def _clean_columns(df, cols):
         "sch": "school",
         "elem": "elementary",
     }
-    for col in cols:
-        df[f"{col}_clean"] = df[f"{col}_clean"].replace(replace)
+    df[clean_cols] = df[clean_cols].replace(replace)
 
     return df
 
@@ -399,9 +428,11 @@ def _test_merge(data, schools, crosswalk, known_missing):
             "All facilities match existing crosswalk; no additional matching necessary"
         )
 
-        # Merge in the full school data
+        # Merge in the full school data, keeping the facility locations
         out = test_merge.loc[~missing_matches0].merge(
-            schools.drop_duplicates(subset=["school_name"]),
+            schools.drop(labels=["geometry"], axis=1).drop_duplicates(
+                subset=["school_name"]
+            ),
             on=["school_name"],
             how="left",
         )
@@ -413,12 +444,38 @@ def _test_merge(data, schools, crosswalk, known_missing):
     return False, data2
 
 
+def _match_nearest(data, schools, max_distance=100):
+    """
+    Match each facility to the only school within the specified distance.
+
+    Facilities with no school, or several schools, nearby are not matched.
+    Distances are in feet.
+    """
+
+    # Only use valid locations, projected to EPSG:2272 (feet)
+    data = data.loc[data.geometry.notnull() & ~data.geometry.is_empty]
+    schools = schools.loc[schools.geometry.notnull() & ~schools.geometry.is_empty]
+    data = data.to_crs(epsg=2272)
+    schools = schools.drop_duplicates(subset=["school_name"]).to_crs(epsg=2272)
+
+    # Pairwise distances between facilities and schools
+    dx = data.geometry.x.to_numpy()[:, None] - schools.geometry.x.to_numpy()
+    dy = data.geometry.y.to_numpy()[:, None] - schools.geometry.y.to_numpy()
+    nearby = np.hypot(dx, dy) <= max_distance
+
+    # Only keep the unambiguous matches
+    names = schools["school_name"].to_numpy()[nearby.argmax(axis=1)]
+    return pd.Series(names, index=data.index).where(nearby.sum(axis=1) == 1)
+
+
 def match_datasets(data, schools):
     """Match the asbestos data set to the schools database."""
 
     # Load the known missing and crosswalk
-    known_missing = pd.read_excel(DATA_DIR / "interim" / "known_missing_matches.xlsx")
-    crosswalk = pd.read_excel(DATA_DIR / "interim" / "crosswalk.xlsx")
+    known_missing = read_excel_cached(
+        DATA_DIR / "interim" / "known_missing_matches.xlsx"
+    )
+    crosswalk = read_excel_cached(DATA_DIR / "interim" / "crosswalk.xlsx")
 
     # This will return if successful
     success, data2 = _test_merge(data, schools, crosswalk, known_missing)
@@ -430,12 +487,12 @@ def match_datasets(data, schools):
     schools = _clean_columns(schools, ["school_name", "school_address"])
 
     # Get the left/right datasets
-    left0 = data2.set_index("permit_number")
-    right0 = schools.drop_duplicates(
+    left = data2.set_index("permit_number")
+    right = schools.drop_duplicates(
         subset=["school_name_clean", "school_address_clean"]
     )
 
-    # Columns to exact merge on
+    # Columns to exact merge on, in order of priority
     merge_columns = [
         ("facility_name_clean", "school_name_clean"),
         ("facility_name_clean", "school_abbreviation"),
@@ -445,28 +502,20 @@ def match_datasets(data, schools):
         ),
     ]
 
-    # Exact merge
-    left = left0.copy()
-    right = right0.copy()
-    exact = None
+    # Exact matches: look up each key, falling back to the next one
+    matched = None
     for (left_on, right_on) in merge_columns:
+        lookup = right.drop_duplicates(subset=[right_on]).set_index(right_on)
+        matches = left[left_on].map(lookup["school_name"])
 
-        exact_matches = (
-            left.reset_index()
-            .merge(
-                right.drop_duplicates(subset=[right_on]),
-                left_on=left_on,
-                right_on=right_on,
-            )
-            .set_index("permit_number")
-        )
-
-        left = left.loc[left.index.difference(exact_matches.index)]
-
-        if exact is None:
-            exact = exact_matches
+        if matched is None:
+            matched = matches
         else:
-            exact = pd.concat([exact, exact_matches])
+            matched = matched.combine_first(matches)
+
+    found = matched.notnull()
+    exact = left.loc[found, ["facility_name"]].assign(school_name=matched[found])
+    left = left.loc[~found]
 
     # Remove known missing
     left = left.loc[~left.facility_name.isin(known_missing.facility_name)]
@@ -491,49 +540,63 @@ def match_datasets(data, schools):
         else:
             raise ValueError("This should not happen!")
 
-    # Do the fuzzy merge
-    out = []
-    out.append(
-        skool.fuzzy_merge(
-            left,
-            right,
-            left_on="facility_name_clean",
-            right_on="school_name_clean",
-            score_cutoff=60,
-            max_matches=1,
-        ).assign(match="name")
+    # Suggest the school at each facility's location for review; only the
+    # facilities still unmatched go on to the fuzzy matching
+    nearest = _match_nearest(left, right).dropna()
+    located = (
+        left.loc[nearest.index, ["facility_name", "facility_address"]]
+        .assign(school_name=nearest)
+        .merge(
+            right.drop_duplicates(subset=["school_name"])[
+                ["school_name", "school_address"]
+            ],
+            on="school_name",
+            how="left",
+        )
+        .assign(match_probability=np.nan, match="location")
     )
-    out.append(
-        skool.fuzzy_merge(
-            left,
-            right.dropna(subset=["school_abbreviation"]),
-            left_on="facility_name_clean",
-            right_on="school_abbreviation",
-            score_cutoff=60,
-            max_matches=1,
-        ).assign(match="abbrev")
+
+    left = left.loc[~left.index.isin(nearest.index)]
+
+    # Match names and abbreviations in a single fuzzy pass
+    choices = pd.concat(
+        [
+            right.assign(school_choice=right["school_name_clean"], match="name"),
+            right.dropna(subset=["school_abbreviation"]).assign(
+                school_choice=lambda df: df["school_abbreviation"], match="abbrev"
+            ),
+        ],
+        ignore_index=True,
     )
 
-    out = pd.concat(out).sort_values(
+    # Do the fuzzy merge, keeping the best match for each facility
+    out = skool.fuzzy_merge(
+        left,
+        choices,
+        left_on="facility_name_clean",
+        right_on="school_choice",
+        score_cutoff=60,
+        max_matches=1,
+    ).sort_values(
         [
             "match_probability",
             "facility_name_clean",
         ],
         ascending=False,
     )
-    out = out.loc[~out.index.duplicated()]
 
-    # Save the fuzzy matches
-    out[
-        [
-            "facility_name",
-            "school_name",
-            "facility_address",
-            "school_address",
-            "match_probability",
-            "match",
-        ]
-    ].to_excel(DATA_DIR / "interim" / "fuzzy_matches.xlsx", index=False)
+    # Save the fuzzy and location matches
+    review_columns = [
+        "facility_name",
+        "school_name",
+        "facility_address",
+        "school_address",
+        "match_probability",
+        "match",
+    ]
+    pd.concat([out[review_columns], located[review_columns]]).to_excel(
+        DATA_DIR / "interim" / "fuzzy_matches.xlsx", index=False
+    )
 
     raise ValueError(
         "See data/interim/fuzzy_matches.xlsx for manual review of fuzzy matches"
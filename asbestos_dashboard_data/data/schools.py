@@ -1,12 +1,64 @@
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import geopandas as gpd
 import numpy as np
 import pandas as pd
 
 from .. import DATA_DIR
 
+# Cache of the parsed schools database
+SCHOOLS_CACHE = DATA_DIR / "interim" / "schools_cache.parquet"
+
+
+def _get_fingerprint():
+    """Hash the contents of the raw school list files."""
+    h = hashlib.sha256()
+    for f in sorted((DATA_DIR / "raw" / "schools").glob("*")):
+        h.update(f.name.encode())
+        h.update(f.read_bytes())
+    return h.hexdigest()
 
+
+@lru_cache(maxsize=1)
 def load_schools_database():
-    """Load the schools database."""
+    """
+    Load the schools database.
+
+    The parsed database is cached to `data/interim/schools_cache.parquet`
+    and only rebuilt when the raw school list files change.
+    """
+    fingerprint = _get_fingerprint()
+
+    # Use the cache if the raw files haven't changed
+    sidecar = SCHOOLS_CACHE.with_suffix(".sha256")
+    if SCHOOLS_CACHE.exists() and sidecar.exists():
+        if sidecar.read_text().strip() == fingerprint:
+            return gpd.read_parquet(SCHOOLS_CACHE)
+
+    # Parse the raw files and save the cache
+    data = _load_schools_database()
+    data.to_parquet(SCHOOLS_CACHE, index=False)
+    sidecar.write_text(fingerprint)
+
+    return data
+
+
+def _read_school_list(f):
+    """Read a single school year's school list."""
+
+    if f.suffix == ".csv":
+        data = pd.read_csv(f)
+    else:
+        data = pd.read_excel(f, sheet_name=1)
+
+    data["School Year"] = f.name.split()[0]
+    return data
+
+
+def _load_schools_database():
+    """Parse the raw school list files."""
 
     # Columns to keep
     columns = [
@@ -22,28 +74,21 @@ def load_schools_database():
         "Year Closed",
     ]
 
-    # Loop over the data files
-    data = []
-    files = (DATA_DIR / "raw" / "schools").glob("2*")
-    for f in sorted(files, reverse=True):
-
-        if f.suffix == ".csv":
-            data.append(pd.read_csv(f))
-        else:
-            data.append(pd.read_excel(f, sheet_name=1))
-
-        data[-1]["School Year"] = f.name.split()[0]
+    # Read the data files in parallel
+    files = sorted((DATA_DIR / "raw" / "schools").glob("2*"), reverse=True)
+    path = DATA_DIR / "raw/schools/Longitudinal School List (20171128).xlsx"
+    with ProcessPoolExecutor() as executor:
+        longitudinal = executor.submit(pd.read_excel, path, sheet_name=1)
+        data = list(executor.map(_read_school_list, files))
 
     # Add the historical data file too
-    path = DATA_DIR / "raw/schools/Longitudinal School List (20171128).xlsx"
     data.append(
-        pd.read_excel(path, sheet_name=1).rename(
-            columns={"Current Year Address": "Street Address"}
-        )
+        longitudinal.result().rename(columns={"Current Year Address": "Street Address"})
     )
 
+    # Combine, de-duplicate, and rename
     data = (
-        pd.concat(data)[columns]
+        pd.concat(data, ignore_index=True)[columns]
         .drop_duplicates(keep="first", subset=["ULCS Code", "Publication Name"])
         .rename(
             columns={
@@ -59,32 +104,33 @@ def load_schools_database():
                 "Year Closed": "year_closed",
             }
         )
-        .assign(
-            school_level=lambda df: df.school_level.str.lower(),
-            year_closed=lambda df: df.year_closed.replace({"open": np.nan}),
-            lat=lambda df: df["gps_location"]
-            .str.split(",")
-            .apply(lambda x: float(x[0]) if not np.isscalar(x) else x),
-            lng=lambda df: df["gps_location"]
-            .str.split(",")
-            .apply(lambda x: float(x[1]) if not np.isscalar(x) else x),
-        )
     )
 
-    # Drop the EOP schools
-    sel = data["school_name"].apply(
-        lambda s: any([word == "EOP" for word in s.split()])
+    # Clean up the columns
+    data["school_level"] = data["school_level"].str.lower()
+    data["school_abbreviation"] = data["school_abbreviation"].str.lower()
+    data["year_closed"] = data["year_closed"].replace({"open": np.nan})
+
+    # Parse the GPS coordinates
+    coords = data["gps_location"].str.split(",", n=1, expand=True)
+    data["lat"] = pd.to_numeric(coords[0], errors="coerce")
+    data["lng"] = pd.to_numeric(coords[1], errors="coerce")
+
+    # Drop the EOP schools and any schools missing a name or address
+    sel = data["school_name"].str.contains(r"(?:^|\s)EOP(?:\s|$)", na=False)
+    data = data.loc[~sel].dropna(subset=["school_name", "school_address"])
+
+    # Convert to a geodataframe
+    geometry = gpd.points_from_xy(
+        data["lng"].to_numpy(), data["lat"].to_numpy(), crs="EPSG:4326"
     )
-    data = data.loc[~sel]
+    data = data.drop(labels=["lat", "lng", "gps_location", "school_year"], axis=1)
 
-    return (
-        gpd.GeoDataFrame(
-            data,
-            geometry=gpd.points_from_xy(data["lng"], data["lat"]),
-            crs="EPSG:4326",
-        )
-        .assign(school_abbreviation=lambda df: df.school_abbreviation.str.lower())
-        .dropna(subset=["school_name", "school_address"])
-        .drop(labels=["lat", "lng", "gps_location", "school_year"], axis=1)
-        .reset_index(drop=True)
+    # Store the low-cardinality string columns as categoricals
+    data = data.astype(
+        {
+            col: "category"
+            for col in ["school_name", "school_abbreviation", "school_level"]
+        }
     )
+    return gpd.GeoDataFrame(data.reset_index(drop=True), geometry=geometry)
@@ -1,10 +1,13 @@
 import datetime
 import os
+import queue
 import re
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from contextlib import contextmanager
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 import pandas as pd
@@ -16,33 +19,96 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import Select, WebDriverWait
 
 from . import DATA_DIR
-from .data.asbestos import extract_asbestos_data
+from .data.asbestos import (
+    extract_asbestos_data,
+    get_latest_raw_file,
+    read_excel_cached,
+)
 
+# The permit search page
+SEARCH_URL = "https://www.citizenserve.com/Portal/PortalController?Action=showSearchPage&ctzPagePrefix=Portal_&installationID=173&original_iid=0&original_contactID=0"
 
-@contextmanager
-def cwd(path):
-    oldpwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(oldpwd)
+# CSS selectors for the permit search
+DROPDOWN_SELECTOR = "select.form-control"
+PERMIT_INPUT_SELECTOR = "#PermitNumber"
+SUBMIT_SELECTOR = "#submitRow button"
+RESULT_LINK_SELECTOR = "#resultContent > table > tbody > tr > td:nth-child(1) > a"
+
+# Extracts the permit page from the search result's javascript link
+PERMIT_LINK_RE = re.compile(r"javascript:openURLLink\(.*(PortalController.*)%.*\)")
+
+# How often explicit waits check their condition, in seconds
+POLL_FREQUENCY = 0.1
+
+# Chrome preferences to block images and notification prompts
+FAST_PREFS = {
+    "profile.managed_default_content_settings.images": 2,
+    "profile.default_content_setting_values.notifications": 2,
+}
 
 
 @contextmanager
 def wait_for_new_window(driver, timeout=30):
     handles_before = driver.window_handles
     yield
-    WebDriverWait(driver, timeout).until(
+    WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY).until(
         lambda driver: len(handles_before) != len(driver.window_handles)
     )
 
 
+def wait_for_download(dirname, timeout=20, poll_frequency=0.1):
+    """Wait for a finished Excel download to show up in the directory."""
+
+    download_dir = Path(dirname)
+    deadline = time.monotonic() + timeout
+    while True:
+        # Chrome writes to a .crdownload file until the download is complete
+        excel_files = list(download_dir.glob("*.xlsx"))
+        partial = list(download_dir.glob("*.crdownload"))
+        if (excel_files and not partial) or time.monotonic() > deadline:
+            return excel_files
+
+        time.sleep(poll_frequency)
+
+
+def get_chrome_service():
+    """
+    Get the chromedriver service.
+
+    This uses the CHROMEDRIVER_PATH environment variable if it is set, and
+    otherwise lets Selenium Manager find the driver (and browser).
+    """
+    path = os.environ.get("CHROMEDRIVER_PATH")
+    if path:
+        return Service(executable_path=path)
+
+    return Service()
+
+
+def _get_fast_options():
+    """Chrome options that skip rendering work the scrapers don't need."""
+
+    options = webdriver.ChromeOptions()
+
+    # Return from page loads once the DOM is ready, without waiting for images
+    options.page_load_strategy = "eager"
+
+    for argument in [
+        "--disable-gpu",
+        "--disable-dev-shm-usage",
+        "--disable-extensions",
+        "--blink-settings=imagesEnabled=false",
+    ]:
+        options.add_argument(argument)
+
+    return options
+
+
 def get_webdriver(browser, dirname, debug=False):
     """Get the webdriver."""
 
     if browser == "chrome":
-        options = webdriver.ChromeOptions()
+        options = _get_fast_options()
         options.add_argument("--no-sandbox")
         if not debug:
             options.add_argument("--headless")
@@ -54,11 +120,12 @@ def get_webdriver(browser, dirname, debug=False):
             ],  # Disable Chrome's PDF Viewer
             "download.default_directory": dirname,
             "download.extensions_to_open": "applications/pdf",
+            **FAST_PREFS,
         }
         options.add_experimental_option("prefs", profile)
 
         # Initialize with options
-        service = Service()
+        service = get_chrome_service()
         driver = webdriver.Chrome(service=service, options=options)
     else:
         raise ValueError("Unknown browser type, should be 'chrome'")
@@ -86,135 +153,184 @@ class DatabaseScraper:
             f"Downloading raw asbestos data for {self.start_date} to {self.end_date}"
         )
 
-    def _init(self, dirname):
+    def _init(self):
         """Initialization function."""
 
+        # Downloads go to a temporary directory that lasts as long as the driver
+        self._download_dir = tempfile.TemporaryDirectory()
+
         # Get the driver
-        self.driver = get_webdriver(self.browser, dirname, debug=self.debug)
+        self.driver = get_webdriver(
+            self.browser, self._download_dir.name, debug=self.debug
+        )
 
-    def run(self):
-        """Scrape remote PDFs."""
+    def close(self):
+        """Quit the driver and remove the download directory."""
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Change the path
-            with cwd(tmpdir):
-                # Initialize if we need to
-                if not hasattr(self, "driver"):
-                    self._init(tmpdir)
+        if hasattr(self, "driver"):
+            self.driver.quit()
+            del self.driver
+            self._download_dir.cleanup()
 
-                self.driver.get("https://citizenserve.com/philagov")
+    def __enter__(self):
+        return self
 
-                link_text = "Reports"
-                WebDriverWait(self.driver, 10).until(
-                    EC.visibility_of_element_located((By.PARTIAL_LINK_TEXT, link_text))
-                )
+    def __exit__(self, *exc_info):
+        self.close()
 
-                a = self.driver.find_element(By.PARTIAL_LINK_TEXT, link_text)
-                a.click()
+    def run(self, start_date=None, end_date=None):
+        """
+        Scrape remote PDFs.
 
-                link_text = "Electronic Asbestos Notifications Report"
-                WebDriverWait(self.driver, 10).until(
-                    EC.visibility_of_element_located((By.PARTIAL_LINK_TEXT, link_text))
-                )
+        The date range defaults to the past `ndays` days, and the driver is
+        re-used across calls.
+        """
+
+        # Initialize if we need to
+        if not hasattr(self, "driver"):
+            self._init()
+
+        # Default to the date range from initialization
+        start_date = start_date or self.start_date
+        end_date = end_date or self.end_date
 
-                # with wait_for_new_window(self.driver):
-                a = self.driver.find_element(By.PARTIAL_LINK_TEXT, link_text)
-                a.click()
+        # Chrome saves the report to the download directory
+        tmpdir = self._download_dir.name
+        self.driver.get("https://citizenserve.com/philagov")
+
+        link_text = "Reports"
+        WebDriverWait(self.driver, 10, poll_frequency=POLL_FREQUENCY).until(
+            EC.visibility_of_element_located((By.PARTIAL_LINK_TEXT, link_text))
+        )
+
+        a = self.driver.find_element(By.PARTIAL_LINK_TEXT, link_text)
+        a.click()
+
+        link_text = "Electronic Asbestos Notifications Report"
+        WebDriverWait(self.driver, 10, poll_frequency=POLL_FREQUENCY).until(
+            EC.visibility_of_element_located((By.PARTIAL_LINK_TEXT, link_text))
+        )
+
+        # with wait_for_new_window(self.driver):
+        a = self.driver.find_element(By.PARTIAL_LINK_TEXT, link_text)
+        a.click()
+
+        # Sleep
+        time.sleep(5)
+        # print(self.driver.window_handles)
+
+        # self.driver.switch_to.window(self.driver.window_handles[1])
+        WebDriverWait(self.driver, 10, poll_frequency=POLL_FREQUENCY).until(
+            EC.visibility_of_element_located((By.CSS_SELECTOR, "#Param_0"))
+        )
+        start_input = self.driver.find_element(By.CSS_SELECTOR, "#Param_0")
+        end_input = self.driver.find_element(By.CSS_SELECTOR, "#Param_1")
 
-                # Sleep
-                time.sleep(5)
-                # print(self.driver.window_handles)
+        start_input.clear()
+        start_input.send_keys(start_date)
+        end_input.clear()
+        end_input.send_keys(end_date)
 
-                # self.driver.switch_to.window(self.driver.window_handles[1])
-                WebDriverWait(self.driver, 10).until(
-                    EC.visibility_of_element_located((By.CSS_SELECTOR, "#Param_0"))
+        self.driver.find_element(By.LINK_TEXT, "SUBMIT").click()
+        WebDriverWait(self.driver, 10, poll_frequency=POLL_FREQUENCY).until(
+            EC.visibility_of_element_located((By.CSS_SELECTOR, ".icon-external-link"))
+        )
+
+        self.driver.execute_script("javascript:exportToExcel();")
+        excel_file = None
+        try:
+            excel_files = wait_for_download(tmpdir)
+
+            if len(excel_files):
+                # Extract the clean data
+                excel_file = excel_files[0]
+                clean_data = extract_asbestos_data(filename=excel_file)
+
+                # The existing latest
+                filename = get_latest_raw_file()
+
+                # Combine and save
+                logger.info(
+                    "Saving new raw database file to data/raw/CitizenserveReport-Latest.xlsx"
                 )
-                start_input = self.driver.find_element(By.CSS_SELECTOR, "#Param_0")
-                end_input = self.driver.find_element(By.CSS_SELECTOR, "#Param_1")
-
-                start_input.clear()
-                start_input.send_keys(self.start_date)
-                end_input.clear()
-                end_input.send_keys(self.end_date)
-
-                self.driver.find_element(By.LINK_TEXT, "SUBMIT").click()
-                WebDriverWait(self.driver, 10).until(
-                    EC.visibility_of_element_located(
-                        (By.CSS_SELECTOR, ".icon-external-link")
-                    )
+                new = read_excel_cached(excel_file).drop_duplicates(subset=["Permit #"])
+
+                # Not cached: the report is rewritten below, so a cache would
+                # never be re-used
+                old = pd.read_excel(filename, sheet_name=0)
+
+                # Keep the first copy of each old permit that isn't in the
+                # new data (new permits take priority), in a single filter
+                old_ids = old["Permit #"]
+                keep = ~old_ids.duplicated() & ~old_ids.isin(new["Permit #"])
+                raw_data = pd.concat([new, old.loc[keep]])
+                raw_data.to_excel(
+                    DATA_DIR / "raw" / "CitizenserveReport-Latest.xlsx",
+                    index=False,
                 )
 
-                self.driver.execute_script("javascript:exportToExcel();")
-                excel_file = None
-                try:
-                    download_dir = Path(tmpdir)
-                    # Initialize
-                    excel_files = list(download_dir.glob("*.xlsx"))
-                    total_sleep = 0
-                    while not len(excel_files) and total_sleep <= 20:
-                        time.sleep(1)
-                        total_sleep += 1
-                        excel_files = list(download_dir.glob("*.xlsx"))
-
-                    if len(excel_files):
-                        # Extract the clean data
-                        excel_file = excel_files[0]
-                        clean_data = extract_asbestos_data(filename=excel_file)
-
-                        # The existing latest
-                        raw_data_files = sorted(
-                            Path(DATA_DIR / "raw").glob("Citizen*.xlsx"),
-                            key=lambda f: os.path.getmtime(f),
-                        )
-                        filename = raw_data_files[-1]
-
-                        # Combine and save
-                        logger.info(
-                            "Saving new raw database file to data/raw/CitizenserveReport-Latest.xlsx"
-                        )
-                        raw_data = pd.concat(
-                            [
-                                pd.read_excel(excel_file, sheet_name=0),
-                                pd.read_excel(filename, sheet_name=0),
-                            ]
-                        ).drop_duplicates(subset=["Permit #"])
-                        raw_data.to_excel(
-                            DATA_DIR / "raw" / "CitizenserveReport-Latest.xlsx",
-                            index=False,
-                        )
-
-                        # Return
-                        return clean_data
-                    else:
-                        raise ValueError("Excel download failed")
-                finally:
-                    # Remove the file after we are done!
-                    if excel_file is not None and excel_file.exists():
-                        excel_file.unlink()
+                # Return
+                return clean_data
+            else:
+                raise ValueError("Excel download failed")
+        finally:
+            # Remove the file (and its parsed cache) after we are done!
+            if excel_file is not None:
+                for f in [excel_file, excel_file.with_suffix(".pkl")]:
+                    if f.exists():
+                        f.unlink()
+
+
+@dataclass
+class RateLimiter:
+    """Space out calls by at least `interval` seconds, across threads."""
+
+    interval: float = 1.0
+    _last: float = field(default=float("-inf"), init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def wait(self):
+        """Sleep only for what's left of the interval since the last call."""
+
+        with self._lock:
+            delay = self._last + self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._last = time.monotonic()
 
 
 def wait_for_element(driver, css_selector, time_limit=10):
     # Wait explicitly until search results load
-    WebDriverWait(driver, time_limit).until(
+    WebDriverWait(driver, time_limit, poll_frequency=POLL_FREQUENCY).until(
         EC.visibility_of_element_located((By.CSS_SELECTOR, css_selector)),
     )
 
 
+def _on_permit_search(driver):
+    """Whether the driver is already on the search page with "Permits" selected."""
+
+    dropdowns = driver.find_elements(By.CSS_SELECTOR, DROPDOWN_SELECTOR)
+    inputs = driver.find_elements(By.CSS_SELECTOR, PERMIT_INPUT_SELECTOR)
+    if not dropdowns or not inputs or not inputs[0].is_displayed():
+        return False
+
+    return Select(dropdowns[0]).first_selected_option.text == "Permits"
+
+
 def _get_url(driver, permit_number):
-    start_url = "https://www.citizenserve.com/Portal/PortalController?Action=showSearchPage&ctzPagePrefix=Portal_&installationID=173&original_iid=0&original_contactID=0"
-    driver.get(start_url)
+    # Only load the search page and select permits if we need to
+    if not _on_permit_search(driver):
+        driver.get(SEARCH_URL)
 
-    # Initial dropdown for permits
-    dropdown_selector = "select.form-control"
-    wait_for_element(driver, dropdown_selector)
-    dropdown = driver.find_element(By.CSS_SELECTOR, dropdown_selector)
-    dropdown_select = Select(dropdown)
-    dropdown_select.select_by_visible_text("Permits")
+        # Initial dropdown for permits
+        wait_for_element(driver, DROPDOWN_SELECTOR)
+        dropdown = driver.find_element(By.CSS_SELECTOR, DROPDOWN_SELECTOR)
+        dropdown_select = Select(dropdown)
+        dropdown_select.select_by_visible_text("Permits")
 
     # Get the input element for the permit number
-    input_selector = "#PermitNumber"
-    wait_for_element(driver, input_selector)
-    input_tag = driver.find_element(By.CSS_SELECTOR, input_selector)
+    wait_for_element(driver, PERMIT_INPUT_SELECTOR)
+    input_tag = driver.find_element(By.CSS_SELECTOR, PERMIT_INPUT_SELECTOR)
 
     # Clear any existing entry
     input_tag.clear()
@@ -222,57 +338,121 @@ def _get_url(driver, permit_number):
     # Input our permit number
     input_tag.send_keys(permit_number)
 
+    # Any results from the previous search
+    old_links = driver.find_elements(By.CSS_SELECTOR, RESULT_LINK_SELECTOR)
+
     # Click select
-    driver.find_element(By.CSS_SELECTOR, "#submitRow button").click()
+    driver.find_element(By.CSS_SELECTOR, SUBMIT_SELECTOR).click()
+
+    # Wait for the old results to be replaced
+    if old_links:
+        WebDriverWait(driver, 10, poll_frequency=POLL_FREQUENCY).until(
+            EC.staleness_of(old_links[0])
+        )
 
     # The link
-    link_selector = "#resultContent > table > tbody > tr > td:nth-child(1) > a"
-    wait_for_element(driver, link_selector)
-    a = driver.find_element(By.CSS_SELECTOR, link_selector)
+    wait_for_element(driver, RESULT_LINK_SELECTOR)
+    a = driver.find_element(By.CSS_SELECTOR, RESULT_LINK_SELECTOR)
     url = a.get_attribute("href")
 
     # Extract
-    match = re.match("javascript:openURLLink\(.*(PortalController.*)%.*\)", url).group(
-        1
-    )
+    match = PERMIT_LINK_RE.match(url).group(1)
     return f"https://www.citizenserve.com/Portal/{match}"
 
 
-def scrape_permit_urls(permit_numbers, log_freq=10):
-    """Scrape the permit URLs."""
+def _get_search_driver():
+    """Start a headless Chrome driver for the permit search."""
 
-    # Get the driver
-    options = webdriver.ChromeOptions()
+    options = _get_fast_options()
     options.add_argument("--headless")
-    service = Service()
-    driver = webdriver.Chrome(service=service, options=options)
+    options.add_experimental_option("prefs", FAST_PREFS)
+    service = get_chrome_service()
+    return webdriver.Chrome(service=service, options=options)
+
+
+def scrape_permit_urls(permit_numbers, log_freq=10, max_workers=4, interval=1.0):
+    """Scrape the permit URLs, using a pool of drivers."""
 
-    out = []
-    for i, permit_number in enumerate(permit_numbers):
+    # Keep at least `interval` seconds between lookups across all workers
+    limiter = RateLimiter(interval)
+
+    # The pool of drivers
+    nworkers = max(1, min(max_workers, len(permit_numbers)))
+    drivers = queue.Queue()
+
+    def worker(i, permit_number):
         if i % log_freq == 0:
             logger.info(i)
 
+        # Borrow a driver from the pool
+        driver = drivers.get()
         try:
+            limiter.wait()
             url = _get_url(driver, permit_number)
         except Exception as e:
             logger.exception(f"exception occurred for permit number = {permit_number}")
             raise e
-        out.append((permit_number, url))
+        finally:
+            drivers.put(driver)
 
-        time.sleep(1)
+        return url
 
-    return pd.DataFrame(out, columns=["permit_number", "permit_url"])
+    try:
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            # Start the browsers concurrently rather than one at a time
+            starting = [executor.submit(_get_search_driver) for _ in range(nworkers)]
+            wait(starting)
+            for future in starting:
+                if future.exception() is None:
+                    drivers.put(future.result())
+
+            # Re-raise any failure to start (the started drivers still get quit)
+            for future in starting:
+                future.result()
+
+            futures = [
+                executor.submit(worker, i, permit_number)
+                for (i, permit_number) in enumerate(permit_numbers)
+            ]
+
+            # Collect in the input order, stopping on the first failure
+            try:
+                urls = [future.result() for future in futures]
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        while not drivers.empty():
+            drivers.get().quit()
+
+    return pd.DataFrame(
+        list(zip(permit_numbers, urls)), columns=["permit_number", "permit_url"]
+    )
 
 
 def update_permit_urls(data):
     """Update permit URLs."""
 
-    # Get the permit numbers too
-    if "permit_url" in data.columns:
-        missing = data["permit_url"].isnull()
-        permit_numbers = data.loc[missing, "permit_number"].unique()
+    # Permit URLs scraped on previous runs
+    cache_file = DATA_DIR / "interim" / "permit-number-urls.csv"
+    if cache_file.exists():
+        cached = pd.read_csv(cache_file)
     else:
-        permit_numbers = data["permit_number"].unique()
+        cached = pd.DataFrame(columns=["permit_url", "permit_number"])
+
+    # Fill in the URLs we already know
+    url_map = cached.drop_duplicates(subset=["permit_number"]).set_index(
+        "permit_number"
+    )["permit_url"]
+    urls = data["permit_number"].map(url_map)
+    if "permit_url" in data.columns:
+        urls = data["permit_url"].fillna(urls)
+    out = data.assign(permit_url=urls)
+
+    # Only scrape the permit numbers that are still missing
+    missing = out["permit_url"].isnull()
+    permit_numbers = out.loc[missing, "permit_number"].unique()
 
     # Get the permit URLs
     if len(permit_numbers):
@@ -280,19 +460,20 @@ def update_permit_urls(data):
         url_data = scrape_permit_urls(permit_numbers)
         logger.info("  ...done")
 
-        # Merge
-        out = pd.merge(
-            data, url_data, on="permit_number", how="left", suffixes=("", "_y")
+        # Map the new URLs onto the data
+        url_map = url_data.drop_duplicates(subset=["permit_number"]).set_index(
+            "permit_number"
+        )["permit_url"]
+        out = out.assign(
+            permit_url=out["permit_url"].fillna(out["permit_number"].map(url_map))
         )
-        if "permit_url_y" in out.columns:
-            out["permit_url"] = out["permit_url"].fillna(out["permit_url_y"])
-            out = out.drop(labels=["permit_url_y"], axis=1)
 
-        # Save
-        out[["permit_url", "permit_number"]].drop_duplicates().to_csv(
-            DATA_DIR / "interim" / "permit-number-urls.csv", index=False
-        )
-    else:
-        out = data
+        # Save, along with the previously cached URLs (writing to a temporary
+        # file first, so an interrupted write can't corrupt the cache)
+        tmp_file = cache_file.with_suffix(".csv.tmp")
+        pd.concat([cached, out[["permit_url", "permit_number"]]]).drop_duplicates(
+            subset=["permit_number"], keep="last"
+        ).to_csv(tmp_file, index=False)
+        os.replace(tmp_file, cache_file)
 
     return out